@@ -0,0 +1,24 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Records are handed to a background thread so writing them never blocks the
+# event loop; the listener is stopped at exit so queued records are flushed.
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+def get_logger(name):
+    """Return a logger whose records are written off the event loop."""
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        logger.propagate = False
+    return logger
@@ -1,25 +1,30 @@
 import os
-import json
-import base64
-from typing import Optional
+from binascii import b2a_base64
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncIterator, Optional
+import httpx
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, WebSocket
 from fastapi.responses import HTMLResponse
 from fastapi.websockets import WebSocketDisconnect
 from twilio.twiml.voice_response import Connect, VoiceResponse
-import requests
 from io import BytesIO
 
+from async_logging import get_logger
+
 load_dotenv()
 
+logger = get_logger(__name__)
+
 # Configuration
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 PORT = int(os.getenv("PORT", 5050))
 VOICE_ID = "21m00Tcm4TlvDq8ikWAM"  # Default voice ID
 MODEL_ID = "eleven_turbo_v2_5"
 SAMPLE_RATE = 8000
-
-app = FastAPI()
+TWILIO_WS_MAX_SIZE = 65536  # Twilio media stream messages are under 1KB
+TTS_CHUNK_SIZE = 320  # 40ms of 8kHz u-law per Twilio media frame
 
 if not ELEVENLABS_API_KEY:
     raise ValueError("Missing the ElevenLabs API key. Please set it in the .env file.")
@@ -29,10 +34,34 @@ class ElevenLabsClient:
     def __init__(self):
         self.api_key = ELEVENLABS_API_KEY
         self.base_url = "https://api.elevenlabs.io/v1"
-
-    async def text_to_speech(self, text: str, voice_id: str = VOICE_ID) -> bytes:
-        """Convert text to speech using ElevenLabs API"""
-        url = f"{self.base_url}/text-to-speech/{voice_id}"
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def connect(self):
+        """Open the HTTP connection pool and warm it up before the first call"""
+        self._client = httpx.AsyncClient(
+            http2=True,
+            timeout=30,
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+        )
+        try:
+            # Any cheap authenticated request completes the TLS/HTTP2 handshake
+            await self._client.get(
+                f"{self.base_url}/models", headers={"xi-api-key": self.api_key}
+            )
+        except httpx.HTTPError as e:
+            logger.warning("Error warming up ElevenLabs connection: %s", e)
+
+    async def aclose(self):
+        """Close the underlying HTTP connection pool"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def stream_tts(
+        self, text: str, voice_id: str = VOICE_ID
+    ) -> AsyncIterator[bytes]:
+        """Stream u-law audio from the ElevenLabs API as it is generated"""
+        url = f"{self.base_url}/text-to-speech/{voice_id}/stream"
 
         headers = {
             "Accept": "audio/basic",  # For u-law
@@ -47,14 +76,29 @@ class ElevenLabsClient:
             "sample_rate": SAMPLE_RATE,
         }
 
-        response = requests.post(url, json=data, headers=headers)
-        response.raise_for_status()
-        return response.content
+        async with self._client.stream(
+            "POST", url, json=data, headers=headers
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size=TTS_CHUNK_SIZE):
+                yield chunk
 
 
 elevenlabs_client = ElevenLabsClient()
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup
+    await elevenlabs_client.connect()
+    yield
+    # Shutdown
+    await elevenlabs_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index_page():
     return "ElevenLabs-Twilio Media Stream Server is running!"
@@ -81,46 +125,60 @@ async def handle_incoming_call(request: Request):
 @app.websocket("/call/connection")
 async def handle_media_stream(websocket: WebSocket):
     """Handle WebSocket connection for ElevenLabs audio streaming"""
-    print("Client connected")
+    logger.debug("Client connected")
     await websocket.accept()
 
     stream_sid: Optional[str] = None
 
     try:
         async for message in websocket.iter_text():
-            data = json.loads(message)
+            data = orjson.loads(message)
 
             if data["event"] == "start":
                 stream_sid = data["start"]["streamSid"]
-                print(f"Stream started: {stream_sid}")
+                logger.debug("Stream started: %s", stream_sid)
 
                 # Get audio from ElevenLabs
                 text = "This is a test message from ElevenLabs. You can now hang up. Thank you."
                 try:
-                    audio_content = await elevenlabs_client.text_to_speech(text)
-
-                    # Send audio to Twilio
-                    audio_message = {
-                        "streamSid": stream_sid,
-                        "event": "media",
-                        "media": {
-                            "payload": base64.b64encode(audio_content).decode("utf-8")
-                        },
-                    }
-                    await websocket.send_json(audio_message)
+                    # Forward audio to Twilio as each chunk arrives, closing the
+                    # HTTP stream even if sending to Twilio fails
+                    async with aclosing(
+                        elevenlabs_client.stream_tts(text)
+                    ) as audio_chunks:
+                        async for chunk in audio_chunks:
+                            audio_message = {
+                                "streamSid": stream_sid,
+                                "event": "media",
+                                "media": {
+                                    "payload": b2a_base64(
+                                        chunk, newline=False
+                                    ).decode("ascii")
+                                },
+                            }
+                            await websocket.send_json(audio_message)
 
                 except Exception as e:
-                    print(f"Error getting audio from ElevenLabs: {e}")
+                    logger.warning("Error getting audio from ElevenLabs: %s", e)
 
     except WebSocketDisconnect:
-        print("Client disconnected")
+        logger.debug("Client disconnected")
     except Exception as e:
-        print(f"Error in websocket handler: {e}")
+        logger.warning("Error in websocket handler: %s", e)
     finally:
-        print("WebSocket connection closed")
+        logger.debug("WebSocket connection closed")
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=PORT,
+        ws="websockets",
+        ws_max_size=TWILIO_WS_MAX_SIZE,
+        ws_per_message_deflate=False,
+        log_level="warning",
+        access_log=False,
+    )
@@ -1,17 +1,26 @@
 import asyncio
-import base64
-import json
 import os
+from collections import deque
 
+import orjson
 import websockets
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, WebSocket
 from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.websockets import WebSocketDisconnect
 from twilio.twiml.voice_response import Connect, VoiceResponse
 
+from async_logging import get_logger
+from relay import (
+    TwilioSendQueue,
+    build_audio_append_frame,
+    build_media_frame_template,
+    run_until_first_done,
+)
+
 load_dotenv()
 
+logger = get_logger(__name__)
+
 # Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PORT = int(os.getenv("PORT", 5050))
@@ -50,6 +59,13 @@ LOG_EVENT_TYPES = [
     "session.created",
 ]
 SHOW_TIMING_MATH = False
+TWILIO_WS_MAX_SIZE = 65536  # Twilio media stream messages are under 1KB
+TWILIO_OUT_QUEUE_SIZE = 256
+OPENAI_WS_MAX_SIZE = 2**22
+OPENAI_WS_MAX_QUEUE = 64
+# Coalesce OpenAI audio deltas into Twilio media frames of up to ~4KB base64
+AUDIO_FLUSH_SIZE = 4096
+AUDIO_FLUSH_INTERVAL = 0.02
 
 app = FastAPI()
 
@@ -80,7 +96,7 @@ async def handle_incoming_call(request: Request):
 @app.websocket("/media-stream")
 async def handle_media_stream(websocket: WebSocket):
     """Handle WebSocket connections between Twilio and OpenAI."""
-    print("Client connected")
+    logger.debug("Client connected")
     await websocket.accept()
 
     async with websockets.connect(
@@ -89,105 +105,158 @@ async def handle_media_stream(websocket: WebSocket):
             "Authorization": f"Bearer {OPENAI_API_KEY}",
             "OpenAI-Beta": "realtime=v1",
         },
+        max_size=OPENAI_WS_MAX_SIZE,
+        compression=None,
+        max_queue=OPENAI_WS_MAX_QUEUE,
     ) as openai_ws:
         await initialize_session(openai_ws)
 
         # Connection specific state
         stream_sid = None
+        media_frame_prefix, media_frame_suffix = build_media_frame_template(stream_sid)
         latest_media_timestamp = 0
         last_assistant_item = None
-        mark_queue = []
+        mark_queue = deque()
         response_start_timestamp_twilio = None
+        twilio_out = TwilioSendQueue(TWILIO_OUT_QUEUE_SIZE)
+        audio_buffer = []
+        audio_buffer_size = 0
 
         async def receive_from_twilio():
             """Receive audio data from Twilio and send it to the OpenAI Realtime API."""
             nonlocal stream_sid, latest_media_timestamp
-            try:
-                async for message in websocket.iter_text():
-                    data = json.loads(message)
-                    if data["event"] == "media" and openai_ws.open:
-                        latest_media_timestamp = int(data["media"]["timestamp"])
-                        audio_append = {
-                            "type": "input_audio_buffer.append",
-                            "audio": data["media"]["payload"],
-                        }
-                        await openai_ws.send(json.dumps(audio_append))
-                    elif data["event"] == "start":
-                        stream_sid = data["start"]["streamSid"]
-                        print(f"Incoming stream has started {stream_sid}")
-                        response_start_timestamp_twilio = None
-                        latest_media_timestamp = 0
-                        last_assistant_item = None
-                    elif data["event"] == "mark":
-                        if mark_queue:
-                            mark_queue.pop(0)
-            except WebSocketDisconnect:
-                print("Client disconnected.")
-                if openai_ws.open:
-                    await openai_ws.close()
+            nonlocal media_frame_prefix, media_frame_suffix
+            # iter_text() ends quietly when Twilio hangs up
+            async for message in websocket.iter_text():
+                data = orjson.loads(message)
+                if data["event"] == "media" and openai_ws.open:
+                    latest_media_timestamp = int(data["media"]["timestamp"])
+                    await openai_ws.send(
+                        build_audio_append_frame(data["media"]["payload"])
+                    )
+                elif data["event"] == "start":
+                    stream_sid = data["start"]["streamSid"]
+                    media_frame_prefix, media_frame_suffix = (
+                        build_media_frame_template(stream_sid)
+                    )
+                    logger.debug("Incoming stream has started %s", stream_sid)
+                    response_start_timestamp_twilio = None
+                    latest_media_timestamp = 0
+                    last_assistant_item = None
+                elif data["event"] == "mark":
+                    if mark_queue:
+                        mark_queue.popleft()
+            logger.debug("Client disconnected.")
+            if openai_ws.open:
+                await openai_ws.close()
 
         async def send_to_twilio():
             """Receive events from the OpenAI Realtime API, send audio back to Twilio."""
             nonlocal stream_sid, last_assistant_item, response_start_timestamp_twilio
+            nonlocal audio_buffer_size
             try:
-                async for openai_message in openai_ws:
-                    response = json.loads(openai_message)
+                while True:
+                    try:
+                        if audio_buffer:
+                            # Flush buffered audio if nothing else arrives in time
+                            openai_message = await asyncio.wait_for(
+                                openai_ws.recv(), timeout=AUDIO_FLUSH_INTERVAL
+                            )
+                        else:
+                            openai_message = await openai_ws.recv()
+                    except asyncio.TimeoutError:
+                        flush_audio_buffer()
+                        continue
+                    except websockets.exceptions.ConnectionClosedOK:
+                        break
+                    response = orjson.loads(openai_message)
                     if response["type"] in LOG_EVENT_TYPES:
-                        print(f"Received event: {response['type']}", response)
+                        logger.debug("Received event: %s %s", response["type"], response)
 
                     if (
                         response.get("type") == "response.audio.delta"
                         and "delta" in response
                     ):
-                        audio_payload = base64.b64encode(
-                            base64.b64decode(response["delta"])
-                        ).decode("utf-8")
-                        audio_delta = {
-                            "event": "media",
-                            "streamSid": stream_sid,
-                            "media": {"payload": audio_payload},
-                        }
-                        await websocket.send_json(audio_delta)
+                        # OpenAI and Twilio both use base64 u-law, forward as-is
+                        audio_payload = response["delta"]
+                        audio_buffer.append(audio_payload)
+                        audio_buffer_size += len(audio_payload)
+                        # Padded base64 cannot be concatenated with what follows
+                        if (
+                            audio_payload.endswith("=")
+                            or audio_buffer_size >= AUDIO_FLUSH_SIZE
+                        ):
+                            flush_audio_buffer()
 
                         if response_start_timestamp_twilio is None:
                             response_start_timestamp_twilio = latest_media_timestamp
                             if SHOW_TIMING_MATH:
-                                print(
-                                    f"Setting start timestamp for new response: {response_start_timestamp_twilio}ms"
+                                logger.debug(
+                                    "Setting start timestamp for new response: %sms",
+                                    response_start_timestamp_twilio,
                                 )
 
                         # Update last_assistant_item safely
                         if response.get("item_id"):
                             last_assistant_item = response["item_id"]
 
-                        await send_mark(websocket, stream_sid)
-
                     # Trigger an interruption. Your use case might work better using `input_audio_buffer.speech_stopped`, or combining the two.
                     if response.get("type") == "input_audio_buffer.speech_started":
-                        print("Speech started detected.")
+                        logger.debug("Speech started detected.")
                         if last_assistant_item:
-                            print(
-                                f"Interrupting response with id: {last_assistant_item}"
+                            logger.debug(
+                                "Interrupting response with id: %s",
+                                last_assistant_item,
                             )
                             await handle_speech_started_event()
             except Exception as e:
-                print(f"Error in send_to_twilio: {e}")
+                logger.warning("Error in send_to_twilio: %s", e)
+
+        def flush_audio_buffer():
+            """Send buffered audio deltas to Twilio as a single media frame."""
+            nonlocal audio_buffer_size
+            if not audio_buffer:
+                return
+            audio_payload = "".join(audio_buffer)
+            audio_buffer.clear()
+            audio_buffer_size = 0
+            twilio_out.put(
+                f'{media_frame_prefix}"{audio_payload}"{media_frame_suffix}',
+                media=True,
+            )
+            send_mark(stream_sid)
+
+        async def twilio_writer():
+            """Drain queued frames to Twilio so a slow socket cannot stall OpenAI."""
+            while True:
+                frame = await twilio_out.get()
+                await websocket.send_text(frame)
 
         async def handle_speech_started_event():
             """Handle interruption when the caller's speech starts."""
             nonlocal response_start_timestamp_twilio, last_assistant_item
-            print("Handling speech started event.")
-            if mark_queue and response_start_timestamp_twilio is not None:
+            nonlocal audio_buffer_size
+            logger.debug("Handling speech started event.")
+            # Buffered deltas have no mark yet but are still audio in flight
+            audio_in_flight = bool(mark_queue or audio_buffer)
+            audio_buffer.clear()
+            audio_buffer_size = 0
+            if audio_in_flight and response_start_timestamp_twilio is not None:
                 elapsed_time = latest_media_timestamp - response_start_timestamp_twilio
                 if SHOW_TIMING_MATH:
-                    print(
-                        f"Calculating elapsed time for truncation: {latest_media_timestamp} - {response_start_timestamp_twilio} = {elapsed_time}ms"
+                    logger.debug(
+                        "Calculating elapsed time for truncation: %s - %s = %sms",
+                        latest_media_timestamp,
+                        response_start_timestamp_twilio,
+                        elapsed_time,
                     )
 
                 if last_assistant_item:
                     if SHOW_TIMING_MATH:
-                        print(
-                            f"Truncating item with ID: {last_assistant_item}, Truncated at: {elapsed_time}ms"
+                        logger.debug(
+                            "Truncating item with ID: %s, Truncated at: %sms",
+                            last_assistant_item,
+                            elapsed_time,
                         )
 
                     truncate_event = {
@@ -196,25 +265,31 @@ async def handle_media_stream(websocket: WebSocket):
                         "content_index": 0,
                         "audio_end_ms": elapsed_time,
                     }
-                    await openai_ws.send(json.dumps(truncate_event))
+                    await openai_ws.send(orjson.dumps(truncate_event).decode())
 
-                await websocket.send_json({"event": "clear", "streamSid": stream_sid})
+                # Discard audio that has not been sent yet before clearing
+                twilio_out.clear()
+                twilio_out.put(
+                    orjson.dumps({"event": "clear", "streamSid": stream_sid}).decode()
+                )
 
                 mark_queue.clear()
                 last_assistant_item = None
                 response_start_timestamp_twilio = None
 
-        async def send_mark(connection, stream_sid):
+        def send_mark(stream_sid):
             if stream_sid:
                 mark_event = {
                     "event": "mark",
                     "streamSid": stream_sid,
                     "mark": {"name": "responsePart"},
                 }
-                await connection.send_json(mark_event)
+                twilio_out.put(orjson.dumps(mark_event).decode())
                 mark_queue.append("responsePart")
 
-        await asyncio.gather(receive_from_twilio(), send_to_twilio())
+        await run_until_first_done(
+            receive_from_twilio(), send_to_twilio(), twilio_writer()
+        )
 
 
 async def send_initial_conversation_item(openai_ws):
@@ -232,8 +307,8 @@ async def send_initial_conversation_item(openai_ws):
             ],
         },
     }
-    await openai_ws.send(json.dumps(initial_conversation_item))
-    await openai_ws.send(json.dumps({"type": "response.create"}))
+    await openai_ws.send(orjson.dumps(initial_conversation_item).decode())
+    await openai_ws.send(orjson.dumps({"type": "response.create"}).decode())
 
 
 async def initialize_session(openai_ws):
@@ -250,8 +325,8 @@ async def initialize_session(openai_ws):
             "temperature": 0.8,
         },
     }
-    print("Sending session update:", json.dumps(session_update))
-    await openai_ws.send(json.dumps(session_update))
+    logger.debug("Sending session update: %s", session_update)
+    await openai_ws.send(orjson.dumps(session_update).decode())
 
     # Uncomment the next line to have the AI speak first
     # await send_initial_conversation_item(openai_ws)
@@ -260,4 +335,13 @@ async def initialize_session(openai_ws):
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=PORT,
+        ws="websockets",
+        ws_max_size=TWILIO_WS_MAX_SIZE,
+        ws_per_message_deflate=False,
+        log_level="warning",
+        access_log=False,
+    )
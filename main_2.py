@@ -1,20 +1,31 @@
 import asyncio
-import base64
-import json
+import functools
 import os
+import time
+from collections import deque
 
+import orjson
 import websockets
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, WebSocket
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.websockets import WebSocketDisconnect
-from twilio.rest import Client
 from twilio.twiml.voice_response import Connect, VoiceResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 
+from async_logging import get_logger
+from relay import (
+    TwilioSendQueue,
+    build_audio_append_frame,
+    build_media_frame_template,
+    run_until_first_done,
+)
+
 load_dotenv()
 
+logger = get_logger(__name__)
+
 # Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
@@ -33,13 +44,56 @@ LOG_EVENT_TYPES = [
     "session.created",
 ]
 SHOW_TIMING_MATH = False
+TWILIO_WS_MAX_SIZE = 65536  # Twilio media stream messages are under 1KB
+TWILIO_OUT_QUEUE_SIZE = 256
+OPENAI_WS_MAX_SIZE = 2**22
+OPENAI_WS_MAX_QUEUE = 64
+# Coalesce OpenAI audio deltas into Twilio media frames of up to ~4KB base64
+AUDIO_FLUSH_SIZE = 4096
+AUDIO_FLUSH_INTERVAL = 0.02
+OPENAI_WS_POOL_SIZE = 4
+# Session time limits count from connect, so don't hand out stale sessions
+OPENAI_WS_POOL_MAX_AGE = 60
+OPENAI_WS_POOL_RETRY_DELAY = 1
+OPENAI_WS_POOL_MAX_RETRY_DELAY = 60
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup
+    app.state.host = os.getenv("HOST", "your-domain.com")
+    pool_task = asyncio.create_task(fill_openai_ws_pool())
+    yield
+    # Shutdown
+    pool_task.cancel()
+    await asyncio.gather(pool_task, return_exceptions=True)
+    while openai_ws_pool:
+        _, openai_ws, watcher = openai_ws_pool.pop()
+        watcher.cancel()
+        await openai_ws.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@functools.lru_cache(maxsize=None)
+def get_twilio_client():
+    """Build the Twilio REST client on first use to keep startup imports light."""
+    from twilio.rest import Client
 
+    return Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
 
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
 
 # Store active calls and their associated OpenAI WebSocket connections
 active_calls = {}
 
+# Pre-connected, pre-initialized OpenAI sessions ready to be handed to a call,
+# as (connected_at, openai_ws, watcher) entries. A slot is taken before
+# connecting and returned when a session leaves the pool, so at most
+# OPENAI_WS_POOL_SIZE idle sessions exist at any time.
+openai_ws_pool = deque()
+openai_ws_pool_slots = asyncio.Semaphore(OPENAI_WS_POOL_SIZE)
+
 
 class OutboundCallRequest(BaseModel):
     phone_number: str
@@ -54,21 +108,13 @@ async def index_page():
 @app.post("/make-call")
 async def make_outbound_call(call_request: OutboundCallRequest):
     """Initiate an outbound call to the specified phone number."""
+    openai_ws = None
     try:
-        # First establish connection with OpenAI
-        openai_ws = await websockets.connect(
-            "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01",
-            extra_headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "OpenAI-Beta": "realtime=v1",
-            },
-        )
-
-        # Initialize the OpenAI session
-        await initialize_session(openai_ws)
+        # Take an already connected and initialized OpenAI session
+        openai_ws = await acquire_openai_ws()
 
         # Store the WebSocket connection
-        call = twilio_client.calls.create(
+        call = get_twilio_client().calls.create(
             to=call_request.phone_number,
             from_=TWILIO_PHONE_NUMBER,
             url=(
@@ -85,6 +131,8 @@ async def make_outbound_call(call_request: OutboundCallRequest):
         return {"message": "Call initiated", "call_sid": call.sid}
 
     except Exception as e:
+        if openai_ws and openai_ws.open:
+            await openai_ws.close()
         return JSONResponse(
             status_code=500, content={"error": f"Failed to initiate call: {str(e)}"}
         )
@@ -141,122 +189,170 @@ async def call_status_callback(request: Request):
 @app.websocket("/media-stream")
 async def handle_media_stream(websocket: WebSocket):
     """Handle WebSocket connections between Twilio and OpenAI."""
-    print("Client connected")
+    logger.debug("Client connected")
     await websocket.accept()
 
     stream_sid = None
+    call_sid = None
+    openai_ws = None
+    media_frame_prefix, media_frame_suffix = build_media_frame_template(stream_sid)
     latest_media_timestamp = 0
     last_assistant_item = None
-    mark_queue = []
+    mark_queue = deque()
     response_start_timestamp_twilio = None
+    twilio_out = TwilioSendQueue(TWILIO_OUT_QUEUE_SIZE)
+    audio_buffer = []
+    audio_buffer_size = 0
 
     try:
         data = await websocket.receive_json()
         if data["event"] == "start":
             stream_sid = data["start"]["streamSid"]
+            media_frame_prefix, media_frame_suffix = build_media_frame_template(
+                stream_sid
+            )
             call_sid = data["start"].get("callSid")
 
             if call_sid in active_calls:
                 # Use the existing OpenAI WebSocket connection for outbound calls
                 openai_ws = active_calls[call_sid]["openai_ws"]
             else:
-                # Create new OpenAI WebSocket connection for inbound calls
-                openai_ws = await websockets.connect(
-                    "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01",
-                    extra_headers={
-                        "Authorization": f"Bearer {OPENAI_API_KEY}",
-                        "OpenAI-Beta": "realtime=v1",
-                    },
-                )
-                await initialize_session(openai_ws)
+                # Take an OpenAI WebSocket connection for inbound calls
+                openai_ws = await acquire_openai_ws()
 
         async def receive_from_twilio():
             """Receive audio data from Twilio and send it to the OpenAI Realtime API."""
             nonlocal stream_sid, latest_media_timestamp
-            try:
-                async for message in websocket.iter_text():
-                    data = json.loads(message)
-                    if data["event"] == "media" and openai_ws.open:
-                        latest_media_timestamp = int(data["media"]["timestamp"])
-                        audio_append = {
-                            "type": "input_audio_buffer.append",
-                            "audio": data["media"]["payload"],
-                        }
-                        await openai_ws.send(json.dumps(audio_append))
-                    elif data["event"] == "start":
-                        stream_sid = data["start"]["streamSid"]
-                        print(f"Incoming stream has started {stream_sid}")
-                        response_start_timestamp_twilio = None
-                        latest_media_timestamp = 0
-                        last_assistant_item = None
-                    elif data["event"] == "mark":
-                        if mark_queue:
-                            mark_queue.pop(0)
-            except WebSocketDisconnect:
-                print("Client disconnected.")
-                if openai_ws.open:
-                    await openai_ws.close()
+            nonlocal media_frame_prefix, media_frame_suffix
+            # iter_text() ends quietly when Twilio hangs up
+            async for message in websocket.iter_text():
+                data = orjson.loads(message)
+                if data["event"] == "media" and openai_ws.open:
+                    latest_media_timestamp = int(data["media"]["timestamp"])
+                    await openai_ws.send(
+                        build_audio_append_frame(data["media"]["payload"])
+                    )
+                elif data["event"] == "start":
+                    stream_sid = data["start"]["streamSid"]
+                    media_frame_prefix, media_frame_suffix = (
+                        build_media_frame_template(stream_sid)
+                    )
+                    logger.debug("Incoming stream has started %s", stream_sid)
+                    response_start_timestamp_twilio = None
+                    latest_media_timestamp = 0
+                    last_assistant_item = None
+                elif data["event"] == "mark":
+                    if mark_queue:
+                        mark_queue.popleft()
+            logger.debug("Client disconnected.")
+            if openai_ws.open:
+                await openai_ws.close()
 
         async def send_to_twilio():
             """Receive events from the OpenAI Realtime API, send audio back to Twilio."""
             nonlocal stream_sid, last_assistant_item, response_start_timestamp_twilio
+            nonlocal audio_buffer_size
             try:
-                async for openai_message in openai_ws:
-                    response = json.loads(openai_message)
+                while True:
+                    try:
+                        if audio_buffer:
+                            # Flush buffered audio if nothing else arrives in time
+                            openai_message = await asyncio.wait_for(
+                                openai_ws.recv(), timeout=AUDIO_FLUSH_INTERVAL
+                            )
+                        else:
+                            openai_message = await openai_ws.recv()
+                    except asyncio.TimeoutError:
+                        flush_audio_buffer()
+                        continue
+                    except websockets.exceptions.ConnectionClosedOK:
+                        break
+                    response = orjson.loads(openai_message)
                     if response["type"] in LOG_EVENT_TYPES:
-                        print(f"Received event: {response['type']}", response)
+                        logger.debug("Received event: %s %s", response["type"], response)
 
                     if (
                         response.get("type") == "response.audio.delta"
                         and "delta" in response
                     ):
-                        audio_payload = base64.b64encode(
-                            base64.b64decode(response["delta"])
-                        ).decode("utf-8")
-                        audio_delta = {
-                            "event": "media",
-                            "streamSid": stream_sid,
-                            "media": {"payload": audio_payload},
-                        }
-                        await websocket.send_json(audio_delta)
+                        # OpenAI and Twilio both use base64 u-law, forward as-is
+                        audio_payload = response["delta"]
+                        audio_buffer.append(audio_payload)
+                        audio_buffer_size += len(audio_payload)
+                        # Padded base64 cannot be concatenated with what follows
+                        if (
+                            audio_payload.endswith("=")
+                            or audio_buffer_size >= AUDIO_FLUSH_SIZE
+                        ):
+                            flush_audio_buffer()
 
                         if response_start_timestamp_twilio is None:
                             response_start_timestamp_twilio = latest_media_timestamp
                             if SHOW_TIMING_MATH:
-                                print(
-                                    f"Setting start timestamp for new response: {response_start_timestamp_twilio}ms"
+                                logger.debug(
+                                    "Setting start timestamp for new response: %sms",
+                                    response_start_timestamp_twilio,
                                 )
 
                         if response.get("item_id"):
                             last_assistant_item = response["item_id"]
 
-                        await send_mark(websocket, stream_sid)
-
                     if response.get("type") == "input_audio_buffer.speech_started":
-                        print("Speech started detected.")
+                        logger.debug("Speech started detected.")
                         if last_assistant_item:
-                            print(
-                                f"Interrupting response with id: {last_assistant_item}"
+                            logger.debug(
+                                "Interrupting response with id: %s",
+                                last_assistant_item,
                             )
                             await handle_speech_started_event()
             except Exception as e:
-                print(f"Error in send_to_twilio: {e}")
+                logger.warning("Error in send_to_twilio: %s", e)
+
+        def flush_audio_buffer():
+            """Send buffered audio deltas to Twilio as a single media frame."""
+            nonlocal audio_buffer_size
+            if not audio_buffer:
+                return
+            audio_payload = "".join(audio_buffer)
+            audio_buffer.clear()
+            audio_buffer_size = 0
+            twilio_out.put(
+                f'{media_frame_prefix}"{audio_payload}"{media_frame_suffix}',
+                media=True,
+            )
+            send_mark(stream_sid)
+
+        async def twilio_writer():
+            """Drain queued frames to Twilio so a slow socket cannot stall OpenAI."""
+            while True:
+                frame = await twilio_out.get()
+                await websocket.send_text(frame)
 
         async def handle_speech_started_event():
             """Handle interruption when the caller's speech starts."""
             nonlocal response_start_timestamp_twilio, last_assistant_item
-            print("Handling speech started event.")
-            if mark_queue and response_start_timestamp_twilio is not None:
+            nonlocal audio_buffer_size
+            logger.debug("Handling speech started event.")
+            # Buffered deltas have no mark yet but are still audio in flight
+            audio_in_flight = bool(mark_queue or audio_buffer)
+            audio_buffer.clear()
+            audio_buffer_size = 0
+            if audio_in_flight and response_start_timestamp_twilio is not None:
                 elapsed_time = latest_media_timestamp - response_start_timestamp_twilio
                 if SHOW_TIMING_MATH:
-                    print(
-                        f"Calculating elapsed time for truncation: {latest_media_timestamp} - {response_start_timestamp_twilio} = {elapsed_time}ms"
+                    logger.debug(
+                        "Calculating elapsed time for truncation: %s - %s = %sms",
+                        latest_media_timestamp,
+                        response_start_timestamp_twilio,
+                        elapsed_time,
                     )
 
                 if last_assistant_item:
                     if SHOW_TIMING_MATH:
-                        print(
-                            f"Truncating item with ID: {last_assistant_item}, Truncated at: {elapsed_time}ms"
+                        logger.debug(
+                            "Truncating item with ID: %s, Truncated at: %sms",
+                            last_assistant_item,
+                            elapsed_time,
                         )
 
                     truncate_event = {
@@ -265,32 +361,116 @@ async def handle_media_stream(websocket: WebSocket):
                         "content_index": 0,
                         "audio_end_ms": elapsed_time,
                     }
-                    await openai_ws.send(json.dumps(truncate_event))
+                    await openai_ws.send(orjson.dumps(truncate_event).decode())
 
-                await websocket.send_json({"event": "clear", "streamSid": stream_sid})
+                # Discard audio that has not been sent yet before clearing
+                twilio_out.clear()
+                twilio_out.put(
+                    orjson.dumps({"event": "clear", "streamSid": stream_sid}).decode()
+                )
 
                 mark_queue.clear()
                 last_assistant_item = None
                 response_start_timestamp_twilio = None
 
-        async def send_mark(connection, stream_sid):
+        def send_mark(stream_sid):
             if stream_sid:
                 mark_event = {
                     "event": "mark",
                     "streamSid": stream_sid,
                     "mark": {"name": "responsePart"},
                 }
-                await connection.send_json(mark_event)
+                twilio_out.put(orjson.dumps(mark_event).decode())
                 mark_queue.append("responsePart")
 
-        await asyncio.gather(receive_from_twilio(), send_to_twilio())
+        await run_until_first_done(
+            receive_from_twilio(), send_to_twilio(), twilio_writer()
+        )
 
     except WebSocketDisconnect:
-        print("Client disconnected")
+        logger.debug("Client disconnected")
+    finally:
+        # Don't wait for the status callback to release the OpenAI session
+        active_calls.pop(call_sid, None)
         if openai_ws and openai_ws.open:
             await openai_ws.close()
 
 
+async def connect_openai_ws():
+    """Open an OpenAI Realtime WebSocket and initialize its session."""
+    openai_ws = await websockets.connect(
+        "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01",
+        extra_headers={
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "OpenAI-Beta": "realtime=v1",
+        },
+        max_size=OPENAI_WS_MAX_SIZE,
+        compression=None,
+        max_queue=OPENAI_WS_MAX_QUEUE,
+    )
+    try:
+        await initialize_session(openai_ws)
+    except BaseException:
+        # Includes cancellation at shutdown, so a half-set-up session isn't leaked
+        await openai_ws.close()
+        raise
+    return openai_ws
+
+
+async def fill_openai_ws_pool():
+    """Keep the warm pool topped up with ready OpenAI sessions."""
+    retry_delay = OPENAI_WS_POOL_RETRY_DELAY
+    while True:
+        await openai_ws_pool_slots.acquire()
+        connected_at = time.monotonic()
+        try:
+            openai_ws = await connect_openai_ws()
+        except Exception as e:
+            openai_ws_pool_slots.release()
+            logger.warning(
+                "Error warming OpenAI connection, retrying in %ss: %s",
+                retry_delay,
+                e,
+            )
+            # Back off so a bad key or an outage doesn't hammer OpenAI or the log
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, OPENAI_WS_POOL_MAX_RETRY_DELAY)
+            continue
+        retry_delay = OPENAI_WS_POOL_RETRY_DELAY
+        watcher = asyncio.create_task(expire_pooled_openai_ws(openai_ws))
+        openai_ws_pool.append((connected_at, openai_ws, watcher))
+
+
+async def expire_pooled_openai_ws(openai_ws):
+    """Drop a pooled session once it closes or ages out, freeing its slot."""
+    try:
+        await asyncio.wait_for(openai_ws.wait_closed(), OPENAI_WS_POOL_MAX_AGE)
+    except asyncio.TimeoutError:
+        pass
+    for entry in openai_ws_pool:
+        if entry[1] is openai_ws:
+            openai_ws_pool.remove(entry)
+            break
+    openai_ws_pool_slots.release()
+    await openai_ws.close()
+
+
+async def acquire_openai_ws():
+    """Take a warm OpenAI session, connecting directly if none is ready."""
+    while openai_ws_pool:
+        # Newest first, so the call gets the most of the session time limit
+        connected_at, openai_ws, watcher = openai_ws_pool.pop()
+        watcher.cancel()
+        openai_ws_pool_slots.release()
+        if (
+            openai_ws.open
+            and time.monotonic() - connected_at < OPENAI_WS_POOL_MAX_AGE
+        ):
+            return openai_ws
+        await openai_ws.close()
+    return await connect_openai_ws()
+
+
 async def initialize_session(openai_ws):
     """Control initial session with OpenAI."""
     session_update = {
@@ -305,20 +485,20 @@ async def initialize_session(openai_ws):
             "temperature": 0.8,
         },
     }
-    print("Sending session update:", json.dumps(session_update))
-    await openai_ws.send(json.dumps(session_update))
-
+    logger.debug("Sending session update: %s", session_update)
+    await openai_ws.send(orjson.dumps(session_update).decode())
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Startup
-    app.state.host = os.getenv("HOST", "your-domain.com")
-    yield
-
-
-app = FastAPI(lifespan=lifespan)
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=PORT,
+        ws="websockets",
+        ws_max_size=TWILIO_WS_MAX_SIZE,
+        ws_per_message_deflate=False,
+        log_level="warning",
+        access_log=False,
+    )
@@ -0,0 +1,113 @@
+import asyncio
+import re
+from collections import deque
+
+import orjson
+
+from async_logging import get_logger
+
+logger = get_logger(__name__)
+
+MEDIA_PAYLOAD_PLACEHOLDER = "__PAYLOAD__"
+DROPPED_FRAMES_LOG_INTERVAL = 250
+BASE64_PATTERN = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+
+
+async def run_until_first_done(*coros):
+    """Run coroutines concurrently, cancelling the rest once any one finishes.
+
+    Either side of the relay ending (Twilio hanging up, OpenAI closing the
+    session, or an error) tears down the whole call.
+    """
+    tasks = [asyncio.create_task(coro) for coro in coros]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class TwilioSendQueue:
+    """Outbound frames for Twilio; when full, the oldest audio frame is evicted.
+
+    Control frames (marks, clear) are never dropped, since Twilio echoes marks
+    back and the interruption logic depends on them.
+    """
+
+    def __init__(self, max_media_frames):
+        self._frames = deque()
+        self._media_frames = 0
+        self._max_media_frames = max_media_frames
+        self._ready = asyncio.Event()
+        self.dropped_media_frames = 0
+
+    def put(self, frame, media=False):
+        if media:
+            if self._media_frames >= self._max_media_frames:
+                self._evict_oldest_media()
+            self._media_frames += 1
+        self._frames.append((frame, media))
+        self._ready.set()
+
+    def clear(self):
+        self._frames.clear()
+        self._media_frames = 0
+
+    async def get(self):
+        while not self._frames:
+            self._ready.clear()
+            await self._ready.wait()
+        frame, media = self._frames.popleft()
+        if media:
+            self._media_frames -= 1
+        return frame
+
+    def _evict_oldest_media(self):
+        for index, (_, media) in enumerate(self._frames):
+            if media:
+                del self._frames[index]
+                self._media_frames -= 1
+                break
+        self.dropped_media_frames += 1
+        if self.dropped_media_frames % DROPPED_FRAMES_LOG_INTERVAL == 1:
+            logger.warning(
+                "Twilio send queue full, %d audio frames dropped so far.",
+                self.dropped_media_frames,
+            )
+
+
+def build_frame_template(message):
+    """Pre-serialize a JSON frame, split around its payload placeholder."""
+    frame = orjson.dumps(message).decode()
+    prefix, suffix = frame.split(f'"{MEDIA_PAYLOAD_PLACEHOLDER}"')
+    return prefix, suffix
+
+
+def build_media_frame_template(stream_sid):
+    """Pre-serialize a Twilio media frame, split around its payload."""
+    return build_frame_template(
+        {
+            "event": "media",
+            "streamSid": stream_sid,
+            "media": {"payload": MEDIA_PAYLOAD_PLACEHOLDER},
+        }
+    )
+
+
+AUDIO_APPEND_PREFIX, AUDIO_APPEND_SUFFIX = build_frame_template(
+    {"type": "input_audio_buffer.append", "audio": MEDIA_PAYLOAD_PLACEHOLDER}
+)
+
+
+def build_audio_append_frame(payload):
+    """Serialize an input_audio_buffer.append frame for a Twilio audio payload."""
+    # Only strict base64 is spliced in verbatim; the payload comes from an
+    # unauthenticated client, so anything else goes through the encoder.
+    if isinstance(payload, str) and BASE64_PATTERN.fullmatch(payload):
+        return f'{AUDIO_APPEND_PREFIX}"{payload}"{AUDIO_APPEND_SUFFIX}'
+    return orjson.dumps(
+        {"type": "input_audio_buffer.append", "audio": payload}
+    ).decode()